@@ -1,29 +1,80 @@
+import copyreg
+import functools
+import io
+import json
+import os
 import pickle
+import pickletools
 import hashlib
 import unittest
 
+_dumps = pickle.dumps
+_loads = pickle.loads
+# A 128-bit BLAKE2b fingerprint is plenty for detecting changed pickle output and is cheaper
+# to initialize and compute than SHA-256 on the short streams these tests produce.
+_blake2b = functools.partial(hashlib.blake2b, digest_size=16)
+
+# Protocol used for the digests persisted in golden_digests.json. It is pinned rather than
+# following pickle.HIGHEST_PROTOCOL so the stored digests stay valid across Python versions.
+GOLDEN_PROTOCOL = 5
+GOLDEN_DIGESTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden_digests.json")
+
+# Values are keyed by a stable name so their golden digests survive values being added or reordered.
+BASIC_TYPE_VALUES = {
+    "int": 42,
+    "float": 3.14159,
+    "str": "hello world",
+    "bytes": b"bytes data",
+    "bool": True,
+    "none": None,
+    "list": [1, 2, 3, 4],
+    "tuple": (5, 6, 7),
+    "dict": {"a": 1, "b": 2},
+    "set": {1, 2, 3},
+    "frozenset": frozenset([4, 5, 6]),
+    "complex": complex(1, 2),
+    "range": range(10),
+}
+EMPTY_CONTAINERS = {
+    "empty_list": [],
+    "empty_tuple": (),
+    "empty_dict": {},
+    "empty_set": set(),
+    "empty_frozenset": frozenset(),
+}
+
+# Protocol 0 (ASCII), protocol 2 (first binary protocol with new-style class support) and the highest
+# protocol cover the meaningful encodings; PICKLE_FULL_PROTOCOL_SWEEP=1 tests every supported protocol.
+if os.environ.get("PICKLE_FULL_PROTOCOL_SWEEP") == "1":
+    PROTOCOLS = list(range(pickle.HIGHEST_PROTOCOL + 1))
+else:
+    PROTOCOLS = sorted({0, 2, pickle.HIGHEST_PROTOCOL})
+
 class MyClass:
     """A simple custom class for testing pickle stability."""
+    __slots__ = ['x', 'y']
     def __init__(self, x, y):
         self.x = x
         self.y = y
     def __eq__(self, other):
-        return isinstance(other, MyClass) and self.x == other.x and self.y == other.y
+        return type(other) is type(self) and self.x == other.x and self.y == other.y
     def __hash__(self):
         return hash((self.x, self.y))
 
 class MySubClass(MyClass):
     """A subclass of MyClass to test subclass pickling stability."""
+    __slots__ = ['z']
     def __init__(self, x, y, z):
         super().__init__(x, y)
         self.z = z
     def __eq__(self, other):
-        return isinstance(other, MySubClass) and super().__eq__(other) and self.z == other.z
+        return type(other) is type(self) and self.x == other.x and self.y == other.y and self.z == other.z
     def __hash__(self):
-        return hash((super().__hash__(), self.z))
+        return hash((self.x, self.y, self.z))
 
 class GetSetStateClass:
     """Class implementing __getstate__ and __setstate__ for custom pickling behavior."""
+    __slots__ = ['data']
     def __init__(self, data):
         self.data = data
     def __getstate__(self):
@@ -31,6 +82,18 @@ class GetSetStateClass:
     def __setstate__(self, state):
         self.data = state
 
+class CopyregClass:
+    """Class pickled through a reducer registered with copyreg instead of the generic __reduce_ex__ dispatch."""
+    __slots__ = ['data']
+    def __init__(self, data):
+        self.data = data
+
+def reduce_copyreg_class(obj):
+    """Reducer registered with copyreg for CopyregClass."""
+    return CopyregClass, (obj.data,)
+
+copyreg.pickle(CopyregClass, reduce_copyreg_class)
+
 class SlotsClass:
     """Class using __slots__ to restrict attributes, testing pickling of slots."""
     __slots__ = ['a', 'b']
@@ -42,81 +105,123 @@ def module_level_func(x):
     """A simple module-level function for testing function pickling."""
     return x * 2
 
+def _dump_reusing(pickler, buf, obj):
+    """
+    Pickle an object through an existing Pickler into a reusable buffer.
+    The buffer is rewound and the memo cleared first, so the output matches a fresh pickle.dumps call.
+    """
+    buf.seek(0)
+    buf.truncate()
+    pickler.clear_memo()
+    pickler.dump(obj)
+    return buf.getvalue()
+
+def _dump_pickle_oob(obj, protocol=pickle.HIGHEST_PROTOCOL):
+    """
+    Pickle an object with out-of-band buffers (protocol 5+) and return the in-band bytes
+    together with a memoryview of every out-of-band buffer, in the order pickle emitted them.
+    """
+    buffers = []
+    data = _dumps(obj, protocol=protocol, buffer_callback=buffers.append)
+    return data, [buf.raw() for buf in buffers]
+
 class TestPickleStability(unittest.TestCase):
     """Test suite to verify pickle serialization stability and consistency."""
 
-    def hash_pickle(self, obj, protocol=None):
+    @classmethod
+    def setUpClass(cls):
+        """
+        Build the shared test objects once and record their golden pickle bytes at the highest protocol.
+        Each stability test then only has to pickle its object once and compare against the golden bytes.
+        """
+        cls.fixtures = {
+            "basic_types": BASIC_TYPE_VALUES,
+            "custom_class": MyClass(10, "test"),
+            "subclass": MySubClass(1, 2, 3),
+            "getsetstate_class": GetSetStateClass({"key": "value"}),
+            "copyreg_class": CopyregClass({"key": "value"}),
+            "slots_class": SlotsClass(1, 2),
+            "exception": ValueError("error message"),
+            "module_level_function": module_level_func,
+            "empty_containers": EMPTY_CONTAINERS,
+        }
+        cls.golden = {name: _dumps(obj, protocol=pickle.HIGHEST_PROTOCOL) for name, obj in cls.fixtures.items()}
+
+    def assert_stable(self, obj, protocol=pickle.HIGHEST_PROTOCOL, msg=None):
         """
-        Helper method to pickle an object and return the SHA-256 hash of the serialized bytes.
-        This is used to verify that repeated serialization produces identical output.
+        Helper method to pickle an object twice and assert that both serializations are byte-identical.
+        Comparing the bytes directly avoids hashing either stream; the first stream is returned for reuse.
         """
-        if protocol is None:
-            data = pickle.dumps(obj)
-        else:
-            data = pickle.dumps(obj, protocol=protocol)
-        return hashlib.sha256(data).hexdigest()
+        data1 = _dumps(obj, protocol=protocol)
+        data2 = _dumps(obj, protocol=protocol)
+        self.assertEqual(data1, data2, msg)
+        return data1
 
-    def round_trip(self, obj, protocol=None):
+    def assert_golden(self, name, msg=None):
         """
-        Helper method to pickle and then unpickle an object, returning the deserialized object.
-        Used to verify round-trip serialization/deserialization behavior.
+        Helper method to pickle the named fixture and assert that the bytes match its golden pickle.
+        Returns the fixture together with the fresh serialization for round-trip checks.
         """
-        if protocol is None:
-            data = pickle.dumps(obj)
-        else:
-            data = pickle.dumps(obj, protocol=protocol)
-        return pickle.loads(data)
+        obj = self.fixtures[name]
+        data = _dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        self.assertEqual(data, self.golden[name], msg)
+        return obj, data
+
+    def golden_digests(self):
+        """
+        Helper method returning the hex BLAKE2b digest of each basic value and empty container, keyed by value name.
+        These are the digests persisted in golden_digests.json.
+        """
+        values = {**BASIC_TYPE_VALUES, **EMPTY_CONTAINERS}
+        return {name: _blake2b(_dumps(value, protocol=GOLDEN_PROTOCOL)).hexdigest() for name, value in values.items()}
 
     def test_basic_types_stability(self):
         """
-        Test that basic data types produce hash-identical pickle output on repeated serialization,
+        Test that basic data types produce pickle output identical to their golden bytes,
         and that round-trip deserialization returns an equivalent object.
+        All values are pickled together as one dict so framing and setup costs are paid once;
+        test_golden_digests reports any changed value by name.
         """
-        test_values = [
-            42,
-            3.14159,
-            "hello world",
-            b"bytes data",
-            True,
-            None,
-            [1, 2, 3, 4],
-            (5, 6, 7),
-            {"a": 1, "b": 2},
-            {1, 2, 3},
-            frozenset([4, 5, 6]),
-            complex(1, 2),
-            range(10)
-        ]
-        for value in test_values:
-            with self.subTest(value=value):
-                hash1 = self.hash_pickle(value)
-                hash2 = self.hash_pickle(value)
-                self.assertEqual(hash1, hash2, f"Pickle output hash differs for value: {value}")
-                round_trip_obj = self.round_trip(value)
-                self.assertEqual(round_trip_obj, value, f"Round-trip deserialization failed for value: {value}")
+        test_values, data = self.assert_golden("basic_types", msg="Pickle output differs for basic type values")
+        round_trip_values = _loads(data)
+        for name, value in test_values.items():
+            self.assertEqual(round_trip_values[name], value, f"Round-trip deserialization failed for value: {value}")
+
+    def test_golden_digests(self):
+        """
+        Test that the per-value pickle digests of the basic types and empty containers match the digests
+        stored in golden_digests.json, reporting which named values changed if they do not.
+        Set PICKLE_UPDATE_GOLDEN=1 to rewrite the stored digests after an intentional change.
+        """
+        digests = self.golden_digests()
+        if os.environ.get("PICKLE_UPDATE_GOLDEN") == "1":
+            with open(GOLDEN_DIGESTS_PATH, "w") as f:
+                json.dump({"protocol": GOLDEN_PROTOCOL, "digests": digests}, f, indent=4)
+                f.write("\n")
+        with open(GOLDEN_DIGESTS_PATH) as f:
+            golden = json.load(f)
+        self.assertEqual(golden["protocol"], GOLDEN_PROTOCOL,
+                         "golden_digests.json was written with a different protocol; regenerate it with PICKLE_UPDATE_GOLDEN=1")
+        changed = sorted(name for name in digests.keys() | golden["digests"].keys()
+                         if digests.get(name) != golden["digests"].get(name))
+        self.assertEqual(changed, [], f"Pickle output differs from golden digests for: {changed}")
 
     def test_custom_class_stability(self):
         """
-        Test that instances of custom classes produce hash-identical pickle output on repeated serialization,
+        Test that instances of custom classes produce pickle output identical to their golden bytes,
         and that round-trip deserialization returns an equivalent object.
         """
-        obj = MyClass(10, "test")
-        hash1 = self.hash_pickle(obj)
-        hash2 = self.hash_pickle(obj)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for custom class instance")
-        round_trip_obj = self.round_trip(obj)
+        obj, data = self.assert_golden("custom_class", msg="Pickle output differs for custom class instance")
+        round_trip_obj = _loads(data)
         self.assertEqual(round_trip_obj, obj, "Round-trip deserialization failed for custom class instance")
 
     def test_subclass_stability(self):
         """
-        Test that instances of subclassed custom classes produce hash-identical pickle output on repeated serialization,
+        Test that instances of subclassed custom classes produce pickle output identical to their golden bytes,
         and that round-trip deserialization returns an equivalent object.
         """
-        obj = MySubClass(1, 2, 3)
-        hash1 = self.hash_pickle(obj)
-        hash2 = self.hash_pickle(obj)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for subclass instance")
-        round_trip_obj = self.round_trip(obj)
+        obj, data = self.assert_golden("subclass", msg="Pickle output differs for subclass instance")
+        round_trip_obj = _loads(data)
         self.assertEqual(round_trip_obj, obj, "Round-trip deserialization failed for subclass instance")
 
     def test_getsetstate_class(self):
@@ -124,23 +229,30 @@ class TestPickleStability(unittest.TestCase):
         Test pickling of class with __getstate__ and __setstate__ methods for custom serialization,
         and verify round-trip deserialization returns an equivalent object.
         """
-        obj = GetSetStateClass({"key": "value"})
-        hash1 = self.hash_pickle(obj)
-        hash2 = self.hash_pickle(obj)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for GetSetStateClass instance")
-        round_trip_obj = self.round_trip(obj)
+        obj, data = self.assert_golden("getsetstate_class", msg="Pickle output differs for GetSetStateClass instance")
+        round_trip_obj = _loads(data)
         self.assertEqual(round_trip_obj.data, obj.data, "Round-trip deserialization failed for GetSetStateClass instance")
 
+    def test_copyreg_class(self):
+        """
+        Test pickling of a class whose reducer is registered with copyreg, checking that the reducer
+        (which passes the data as a constructor argument, so no BUILD opcode is emitted) is what pickle used,
+        and verify round-trip deserialization returns an equivalent object.
+        """
+        obj, data = self.assert_golden("copyreg_class", msg="Pickle output differs for CopyregClass instance")
+        self.assertIs(copyreg.dispatch_table.get(CopyregClass), reduce_copyreg_class, "CopyregClass reducer is not registered with copyreg")
+        opcodes = {opcode.name for opcode, _, _ in pickletools.genops(data)}
+        self.assertNotIn("BUILD", opcodes, "CopyregClass was pickled through the generic state path instead of its reducer")
+        round_trip_obj = _loads(data)
+        self.assertEqual(round_trip_obj.data, obj.data, "Round-trip deserialization failed for CopyregClass instance")
+
     def test_slots_class(self):
         """
         Test pickling of class with __slots__ attribute to ensure slot attributes are serialized correctly,
         and verify round-trip deserialization returns an equivalent object.
         """
-        obj = SlotsClass(1, 2)
-        hash1 = self.hash_pickle(obj)
-        hash2 = self.hash_pickle(obj)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for SlotsClass instance")
-        round_trip_obj = self.round_trip(obj)
+        obj, data = self.assert_golden("slots_class", msg="Pickle output differs for SlotsClass instance")
+        round_trip_obj = _loads(data)
         self.assertEqual((round_trip_obj.a, round_trip_obj.b), (obj.a, obj.b), "Round-trip deserialization failed for SlotsClass instance")
 
     def test_circular_reference(self):
@@ -151,10 +263,8 @@ class TestPickleStability(unittest.TestCase):
         a = []
         b = [a]
         a.append(b)
-        hash1 = self.hash_pickle(a)
-        hash2 = self.hash_pickle(a)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for circular reference")
-        round_trip_obj = self.round_trip(a)
+        data = self.assert_stable(a, msg="Pickle output differs for circular reference")
+        round_trip_obj = _loads(data)
         self.assertEqual(len(round_trip_obj), 1, "Round-trip deserialization failed for circular reference")
         self.assertIs(round_trip_obj[0][0], round_trip_obj, "Round-trip deserialization failed to preserve circular reference")
 
@@ -163,11 +273,8 @@ class TestPickleStability(unittest.TestCase):
         Test pickling of exception instances to ensure exceptions serialize and deserialize consistently,
         and verify round-trip deserialization returns an equivalent exception.
         """
-        exc = ValueError("error message")
-        hash1 = self.hash_pickle(exc)
-        hash2 = self.hash_pickle(exc)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for exception instance")
-        round_trip_obj = self.round_trip(exc)
+        exc, data = self.assert_golden("exception", msg="Pickle output differs for exception instance")
+        round_trip_obj = _loads(data)
         self.assertEqual(str(round_trip_obj), str(exc), "Round-trip deserialization failed for exception instance")
 
     def test_module_level_function(self):
@@ -175,43 +282,71 @@ class TestPickleStability(unittest.TestCase):
         Test pickling of a module-level function to verify functions defined at module scope are pickled consistently,
         and verify round-trip deserialization returns the same function object.
         """
-        hash1 = self.hash_pickle(module_level_func)
-        hash2 = self.hash_pickle(module_level_func)
-        self.assertEqual(hash1, hash2, "Pickle output hash differs for module-level function")
-        round_trip_obj = self.round_trip(module_level_func)
-        self.assertEqual(round_trip_obj, module_level_func, "Round-trip deserialization failed for module-level function")
+        func, data = self.assert_golden("module_level_function", msg="Pickle output differs for module-level function")
+        round_trip_obj = _loads(data)
+        self.assertIs(round_trip_obj, func, "Round-trip deserialization failed for module-level function")
 
     def test_empty_containers(self):
         """
         Test stability of empty containers including list, tuple, dict, set, and frozenset,
         and verify round-trip deserialization returns equivalent empty containers.
+        The containers are pickled together as one dict and checked one by one after loading.
         """
-        containers = [[], (), {}, set(), frozenset()]
-        for container in containers:
-            with self.subTest(container=container):
-                hash1 = self.hash_pickle(container)
-                hash2 = self.hash_pickle(container)
-                self.assertEqual(hash1, hash2, f"Pickle output hash differs for empty container: {container}")
-                round_trip_obj = self.round_trip(container)
-                self.assertEqual(round_trip_obj, container, f"Round-trip deserialization failed for empty container: {container}")
+        containers, data = self.assert_golden("empty_containers", msg="Pickle output differs for empty containers")
+        round_trip_containers = _loads(data)
+        for name, container in containers.items():
+            self.assertEqual(round_trip_containers[name], container, f"Round-trip deserialization failed for empty container: {container}")
+
+    def test_bytes_buffer_stability(self):
+        """
+        Test that bytes data passed out-of-band through pickle.PickleBuffer produces identical output on repeated serialization,
+        and verify round-trip deserialization with the same buffers returns equivalent data.
+        """
+        payload = b"bytes data" * 1024
+        # Each dump gets its own copy of the payload, so equal buffers mean equal content, not shared memory.
+        data, buffers = _dump_pickle_oob({"header": b"bytes data", "payload": pickle.PickleBuffer(bytearray(payload))})
+        data2, buffers2 = _dump_pickle_oob({"header": b"bytes data", "payload": pickle.PickleBuffer(bytearray(payload))})
+        self.assertEqual(data, data2, "In-band pickle output differs for out-of-band buffer data")
+        self.assertEqual(len(buffers), 1, "Payload was not serialized out-of-band")
+        self.assertEqual(len(buffers2), len(buffers), "Out-of-band buffer count differs between serializations")
+        self.assertEqual(buffers, buffers2, "Out-of-band buffer contents or order differ between serializations")
+        self.assertNotIn(payload, data, "Payload was copied into the in-band pickle stream")
+        round_trip_obj = _loads(data, buffers=buffers)
+        self.assertEqual(round_trip_obj["header"], b"bytes data", "Round-trip deserialization failed for in-band bytes")
+        self.assertEqual(bytes(round_trip_obj["payload"]), payload, "Round-trip deserialization failed for out-of-band buffer")
 
     def test_unpicklable_lambda(self):
         """
-        Test that unpicklable lambda functions raise an exception when pickled.
+        Test that unpicklable lambda functions raise a pickling error when pickled.
+        Protocols 4 and up look the lambda up by qualified name, which older Pythons report as AttributeError.
         """
-        with self.assertRaises(Exception):
-            pickle.dumps(lambda x: x)
+        with self.assertRaises((pickle.PicklingError, AttributeError)):
+            _dumps(lambda x: x, protocol=pickle.HIGHEST_PROTOCOL)
 
-    def test_pickle_protocols(self):
+def _make_protocol_test(protocol):
+    """
+    Build a test method checking pickle stability for a single protocol. One method is generated per
+    entry in PROTOCOLS so test runners that distribute test items (such as pytest-xdist) can split the sweep.
+    """
+    def test(self):
         """
-        Test that pickle output is stable across multiple serializations for all supported pickle protocols.
+        Test that pickle output is stable across multiple serializations with one protocol and matches pickle.dumps,
+        and that the canonical form produced by pickletools.optimize is no larger and still round-trips.
         """
         value = {"key": "value", "number": 12345}
-        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
-            with self.subTest(protocol=protocol):
-                hash1 = self.hash_pickle(value, protocol=protocol)
-                hash2 = self.hash_pickle(value, protocol=protocol)
-                self.assertEqual(hash1, hash2, f"Pickle output hash differs for protocol {protocol}")
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, protocol=protocol)
+        data = _dump_reusing(pickler, buf, value)
+        self.assertEqual(data, _dump_reusing(pickler, buf, value), f"Pickle output differs for protocol {protocol}")
+        self.assertEqual(data, _dumps(value, protocol=protocol), f"Reused Pickler output differs from pickle.dumps for protocol {protocol}")
+        optimized = pickletools.optimize(data)
+        self.assertLessEqual(len(optimized), len(data), f"Optimized pickle output grew for protocol {protocol}")
+        self.assertEqual(_loads(optimized), value, f"Round-trip of optimized pickle failed for protocol {protocol}")
+    return test
+
+for _protocol in PROTOCOLS:
+    setattr(TestPickleStability, f"test_pickle_protocol_{_protocol}", _make_protocol_test(_protocol))
+del _protocol
 
 if __name__ == "__main__":
     unittest.main()